@@ -1,14 +1,19 @@
-from random import normalvariate, random
+from random import gauss, random
 from datetime import timedelta, datetime
+from time import monotonic
+from collections import deque
+from bisect import bisect_left, bisect_right, insort
+from itertools import count, takewhile
 import csv
-import dateutil.parser
 import os.path
 import operator
-import json
+import orjson
 import re
 import threading
 import http.server
 from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qsl
+from concurrent.futures import ThreadPoolExecutor
 
 ################################################################################
 #
@@ -25,6 +30,15 @@ FREQ = (12, 36, 50)     # Frequency parameters (min, max, std)
 
 # Trades
 OVERLAP = 4
+TICKS = 100  # Price ticks per unit
+
+# Server
+# Each connection holds one of HTTP_THREADS workers while it is served, so at
+# most HTTP_THREADS clients are served at once. Further connections wait in an
+# unbounded queue, and keep-alive connections give up their worker while any
+# are waiting.
+HTTP_THREADS = int(os.environ.get('HTTP_THREADS', 8))  # Request worker pool size
+HTTP_KEEPALIVE = 1  # Seconds an idle keep-alive connection holds a worker
 
 ################################################################################
 #
@@ -34,7 +48,7 @@ def bwalk(min, max, std):
     """ Generates a bounded random walk. """
     rng = max - min
     while True:
-        max += normalvariate(0, std)
+        max += gauss(0, std)
         yield abs((max % (rng * 2)) - rng) + min
 
 def market(t0=MARKET_OPEN):
@@ -48,56 +62,93 @@ def orders(hist):
     for t, px, spd in hist:
         stock = 'ABC' if random() > 0.5 else 'DEF'
         side, d = ('sell', 2) if random() > 0.5 else ('buy', -2)
-        order = round(normalvariate(px + (spd / d), spd / OVERLAP), 2)
-        size = int(abs(normalvariate(0, 100)))
+        order = round(gauss(px + (spd / d), spd / OVERLAP), 2)
+        size = int(abs(gauss(0, 100)))
         yield t, stock, side, order, size
 
 ################################################################################
 #
 # Order Book
 
-def add_book(book, order, size, _age=10):
-    """ Adds a new order and size to a book, and ages the rest of the book. """
-    yield order, size, _age
-    for o, s, age in book:
-        if age > 0:
-            yield o, s, age - 1
+ranks = {
+    'buy': operator.neg,
+    'sell': operator.pos,
+}
+
+stamps = count()
+
+def add_book(book, recent, order, size, rank, _age=10):
+    """ Adds a new order and size to a book behind any orders at the same
+        price, and expires the order placed _age + 1 orders before it.
+        Entries are (rank, stamp, price, size), so that they sort in
+        price-time priority as plain tuples.
+    """
+    entry = (rank(order), next(stamps), order, size)
+    insort(book, entry)
+    recent.append(entry)
+    if len(recent) > _age + 1:
+        expired = recent.popleft()
+        i = bisect_left(book, expired[:2])
+        if i < len(book) and book[i][1] == expired[1]:
+            del book[i]
+
+def top(book):
+    """ Returns the (price, size) at the top of a book, or None if empty. """
+    return book[0][2:] if book else None
 
 def clear_order(order, size, book, op=operator.ge, _notional=0):
-    """ Tries to clear a sized order against a book, returning a tuple of
-        (notional, new_book) if successful, and None if not.
+    """ Clears a sized order against a book in place, returning a tuple of
+        (notional, unfilled size).
     """
-    (top_order, top_size, age), tail = book[0], book[1:]
-    if op(order, top_order):
-        _notional += min(size, top_size) * top_order
-        sdiff = top_size - size
-        if sdiff > 0:
-            return _notional, list(add_book(tail, top_order, sdiff, age))
-        elif len(tail) > 0:
-            return clear_order(order, -sdiff, tail, op, _notional)
+    while book and op(order, book[0][2]):
+        rank, stamp, top_order, top_size = book[0]
+        fill = min(size, top_size)
+        _notional += fill * top_order
+        size -= fill
+        if top_size > fill:
+            book[0] = (rank, stamp, top_order, top_size - fill)
+            break
+        book.popleft()
+    return _notional, size
 
 def clear_book(buy=None, sell=None):
-    """ Clears all crossed orders from a buy and sell book, returning the new
-        books uncrossed.
+    """ Clears all crossed orders from a buy and sell book in place, returning
+        the books uncrossed.
     """
     while buy and sell:
-        order, size, _ = buy[0]
-        new_book = clear_order(order, size, sell)
-        if new_book:
-            sell = new_book[1]
-            buy = buy[1:]
-        else:
+        rank, stamp, order, size = buy[0]
+        if order < sell[0][2]:
+            break
+        _, unfilled = clear_order(order, size, sell)
+        if unfilled:
+            buy[0] = (rank, stamp, order, unfilled)
             break
+        buy.popleft()
     return buy, sell
 
-def order_book(orders, book, stock_name):
-    """ Generates a series of order books from a series of orders. """
+def order_book(orders, books):
+    """ Generates a series of order books from a series of orders, keeping a
+        buy and sell book per stock in books and skipping other stocks.
+    """
+    recent = {stock: {'buy': deque(), 'sell': deque()} for stock in books}
     for t, stock, side, order, size in orders:
-        if stock_name == stock:
-            new = add_book(book.get(side, []), order, size)
-            book[side] = sorted(new, reverse=side == 'buy', key=lambda x: x[0])
-        bids, asks = clear_book(**book)
-        yield t, bids, asks
+        if stock in books:
+            book = books[stock]
+            add_book(book[side], recent[stock][side], order, size, ranks[side])
+            clear_book(**book)
+        yield t, books
+
+def replay(orders, stocks):
+    """ Replays a series of orders through a book per stock, returning a list
+        of timestamps and a parallel list of (time, (top bid, top ask), ...)
+        with one pair per stock.
+    """
+    books = {stock: {'buy': deque(), 'sell': deque()} for stock in stocks}
+    times, tops = [], []
+    for t, books in order_book(orders, books):
+        times.append(t)
+        tops.append((t,) + tuple((top(b['buy']), top(b['sell'])) for b in books.values()))
+    return times, tops
 
 ################################################################################
 #
@@ -105,24 +156,57 @@ def order_book(orders, book, stock_name):
 
 def generate_csv():
     """ Generates a CSV of order history. """
-    with open('test.csv', 'w', newline='') as f:
+    end = MARKET_OPEN + SIM_LENGTH
+    with open('test.csv', 'w', newline='', buffering=1 << 20) as f:
         writer = csv.writer(f)
-        for t, stock, side, order, size in orders(market()):
-            if t > MARKET_OPEN + SIM_LENGTH:
-                break
-            writer.writerow([t, stock, side, order, size])
+        writer.writerows(takewhile(lambda x: x[0] <= end, orders(market())))
 
 def read_csv():
-    """ Reads a CSV of order history into a list. """
+    """ Reads a CSV of order history into a list, with prices in ticks. """
     with open('test.csv', 'r', newline='') as f:
-        for time, stock, side, order, size in csv.reader(f):
-            yield dateutil.parser.parse(time), stock, side, float(order), int(size)
+        return [(datetime.fromisoformat(time), stock, side, round(float(order) * TICKS), int(size))
+                for time, stock, side, order, size in csv.reader(f)]
 
 ################################################################################
 #
 # Server
 
-class ThreadedHTTPServer(ThreadingMixIn, http.server.HTTPServer):
+class ThreadPoolMixIn(ThreadingMixIn):
+    """ Mix-in class to handle requests on a bounded pool of worker threads
+        rather than a new thread per request. Connections beyond the pool
+        size queue without limit until a worker is free.
+    """
+    max_workers = HTTP_THREADS
+
+    def __init__(self, *args, **kwargs):
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._queued = 0
+        self._queued_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def queued(self):
+        """ Number of connections waiting for a free worker. """
+        return self._queued
+
+    def process_request(self, request, client_address):
+        """ Hands the request off to the worker pool. """
+        with self._queued_lock:
+            self._queued += 1
+        self._pool.submit(self._process_queued, request, client_address)
+
+    def _process_queued(self, request, client_address):
+        """ Handles a request once a worker picks it up. """
+        with self._queued_lock:
+            self._queued -= 1
+        self.process_request_thread(request, client_address)
+
+    def server_close(self):
+        """ Closes the server and stops the worker pool. """
+        super().server_close()
+        self._pool.shutdown(wait=False)
+
+class ThreadedHTTPServer(ThreadPoolMixIn, http.server.HTTPServer):
     """ Multithreaded HTTP Server class with proper shutdown. """
     allow_reuse_address = True
 
@@ -138,37 +222,52 @@ def route(path):
         return f
     return _route
 
-def read_params(path):
-    """ Reads query parameters into a dictionary. """
-    query = path.split('?')
-    if len(query) > 1:
-        query = query[1].split('&')
-        return dict(map(lambda x: x.split('='), query))
+def route_table(routes):
+    """ Builds a list of (compiled path pattern, method) for the routed
+        methods of an object.
+    """
+    return [(re.compile(handler.__route__), handler)
+            for handler in routes.__class__.__dict__.values()
+            if hasattr(handler, "__route__")]
 
-def get(req_handler, routes):
+def get(req_handler, routes, table):
     """ Maps a request to the appropriate route. """
-    for name, handler in routes.__class__.__dict__.items():
-        if hasattr(handler, "__route__"):
-            if None != re.search(handler.__route__, req_handler.path):
-                req_handler.send_response(200)
-                req_handler.send_header('Content-Type', 'application/json')
-                req_handler.send_header('Access-Control-Allow-Origin', '*')
-                req_handler.end_headers()
-                params = read_params(req_handler.path)
-                data = json.dumps(handler(routes, params)) + '\n'
-                req_handler.wfile.write(bytes(data, encoding='utf-8'))
-                return
+    url = urlsplit(req_handler.path)
+    for pattern, handler in table:
+        if pattern.search(url.path):
+            params = dict(parse_qsl(url.query))
+            data = orjson.dumps(handler(routes, params)) + b'\n'
+            req_handler.send_response(200)
+            req_handler.send_header('Content-Type', 'application/json')
+            req_handler.send_header('Content-Length', str(len(data)))
+            req_handler.send_header('Access-Control-Allow-Origin', '*')
+            if req_handler.server.queued:
+                # Give up this worker so that waiting connections get served
+                req_handler.send_header('Connection', 'close')
+            req_handler.end_headers()
+            req_handler.wfile.write(data)
+            return
+    req_handler.send_error(404)
+
+def make_server(routes, host='0.0.0.0', port=8080):
+    """ Creates a threaded, keep-alive HTTP server for an object's routes. """
+    table = route_table(routes)
 
-def run(routes, host='0.0.0.0', port=8080):
-    """ Runs the server with threaded HTTP handling. """
     class RequestHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        timeout = HTTP_KEEPALIVE
+
         def log_message(self, *args, **kwargs):
             pass
 
         def do_GET(self):
-            get(self, routes)
+            get(self, routes, table)
+
+    return ThreadedHTTPServer((host, port), RequestHandler)
 
-    server = ThreadedHTTPServer((host, port), RequestHandler)
+def run(routes, host='0.0.0.0', port=8080):
+    """ Runs the server with threaded, keep-alive HTTP handling. """
+    server = make_server(routes, host, port)
     try:
         print(f"HTTP server started on port {port}")
         server.serve_forever()
@@ -190,50 +289,40 @@ class App(object):
     """ Main application class for the trading game server. """
 
     def __init__(self):
-        self._book_1 = dict()
-        self._book_2 = dict()
-        self._data_1 = None
-        self._data_2 = None
-        self._rt_start = datetime.now()
+        self._feed = None
+        self._index = 0
+        self._rt_start = monotonic()
         self._sim_start = None
         self.initialize_data_feeds()
 
     def initialize_data_feeds(self):
         """ Initializes data feeds and handles errors. """
         try:
-            self._data_1 = order_book(read_csv(), self._book_1, 'ABC')
-            self._data_2 = order_book(read_csv(), self._book_2, 'DEF')
-            self._sim_start, _, _ = next(self._data_1)
+            if self._feed is None:
+                self._feed = replay(read_csv(), ('ABC', 'DEF'))
+            self._sim_start = self._feed[0][0]
+            self._index = 1
             self.read_10_first_lines()
         except Exception as e:
             print(f"Error initializing data feeds: {e}")
             # Optionally handle initialization errors here
 
     @property
-    def _current_book_1(self):
-        """ Generator for current book 1. """
-        for t, bids, asks in self._data_1:
-            if REALTIME:
-                while t > self._sim_start + (datetime.now() - self._rt_start):
-                    yield t, bids, asks
-            else:
-                yield t, bids, asks
-
-    @property
-    def _current_book_2(self):
-        """ Generator for current book 2. """
-        for t, bids, asks in self._data_2:
-            if REALTIME:
-                while t > self._sim_start + (datetime.now() - self._rt_start):
-                    yield t, bids, asks
-            else:
-                yield t, bids, asks
+    def _current_book(self):
+        """ Current books, raising StopIteration once the feed is exhausted. """
+        times, tops = self._feed
+        i = self._index
+        if REALTIME:
+            now = self._sim_start + timedelta(seconds=monotonic() - self._rt_start)
+            i = bisect_right(times, now, i)
+        if i >= len(times):
+            raise StopIteration
+        self._index = i + 1
+        return tops[i]
 
     def read_10_first_lines(self):
         """ Reads the first 10 lines from data feeds. """
-        for _ in range(10):
-            next(self._data_1)
-            next(self._data_2)
+        self._index = min(self._index + 10, len(self._feed[0]))
 
     # @route('/query')
     # def handle_query(self, x):
@@ -271,32 +360,29 @@ class App(object):
     def handle_query(self, x):
         """ Handles query requests. """
         try:
-            t1, bids1, asks1 = next(self._current_book_1)
-            t2, bids2, asks2 = next(self._current_book_2)
+            t, (bid1, ask1), (bid2, ask2) = self._current_book
         except StopIteration:
             print("Data feed exhausted, reinitializing...")
             self.initialize_data_feeds()  # Reinitialize data feeds
-            t1, bids1, asks1 = next(self._current_book_1)
-            t2, bids2, asks2 = next(self._current_book_2)
+            t, (bid1, ask1), (bid2, ask2) = self._current_book
 
-        t = max(t1, t2) if t1 and t2 else t1 or t2
         print(f'Query received @ t {t}')
 
     
         return [
             {
-                'id': x and x.get('id', None),
+                'id': x.get('id'),
                 'stock': 'ABC',
-                'timestamp': str(t),
-                'top_bid': bids1 and {'price': bids1[0][0], 'size': bids1[0][1]},
-                'top_ask': asks1 and {'price': asks1[0][0], 'size': asks1[0][1]}
+                'timestamp': t,
+                'top_bid': {'price': bid1[0] / TICKS, 'size': bid1[1]} if bid1 else None,
+                'top_ask': {'price': ask1[0] / TICKS, 'size': ask1[1]} if ask1 else None
             },
             {
-                'id': x and x.get('id', None),
+                'id': x.get('id'),
                 'stock': 'DEF',
-                'timestamp': str(t),
-                'top_bid': bids2 and {'price': bids2[0][0], 'size': bids2[0][1]},
-                'top_ask': asks2 and {'price': asks2[0][0], 'size': asks2[0][1]}
+                'timestamp': t,
+                'top_bid': {'price': bid2[0] / TICKS, 'size': bid2[1]} if bid2 else None,
+                'top_ask': {'price': ask2[0] / TICKS, 'size': ask2[1]} if ask2 else None
             }
         ]
 
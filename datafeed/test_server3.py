@@ -0,0 +1,50 @@
+import http.client
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+import server3
+
+WORKERS = 2
+
+
+class KeepAliveTest(unittest.TestCase):
+    """ Keep-alive pollers must not starve clients out of the worker pool. """
+
+    def setUp(self):
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        self.addCleanup(os.chdir, cwd)
+        with mock.patch.object(server3.ThreadedHTTPServer, 'max_workers', WORKERS):
+            self.server = server3.make_server(server3.App(), '127.0.0.1', 0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def poll(self, served, polls=40):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=1)
+        try:
+            for _ in range(polls):
+                conn.request('GET', '/query?id=1')
+                response = conn.getresponse()
+                response.read()
+                if response.status == 200:
+                    served.append(1)
+                time.sleep(0.05)
+        finally:
+            conn.close()
+
+    def test_more_pollers_than_workers_are_all_served(self):
+        served = [[] for _ in range(WORKERS + 2)]
+        pollers = [threading.Thread(target=self.poll, args=(s,)) for s in served]
+        for poller in pollers:
+            poller.start()
+        for poller in pollers:
+            poller.join(timeout=15)
+        self.assertEqual([len(s) for s in served], [40] * len(served))
+
+
+if __name__ == '__main__':
+    unittest.main()